@@ -0,0 +1,80 @@
+import json
+from pathlib import Path
+from typing import Literal
+from urllib.parse import quote, quote_plus, unquote_plus
+from pydantic import BaseModel
+
+SCRUBBED_USERNAME = "scrubbed-user"
+SCRUBBED_PASSWORD = "scrubbed-password"
+SCRUBBED_HEADERS = {"authorization", "cookie", "set-cookie"}
+URL_HEADERS = {"location", "referer"}
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class HarConfig(BaseModel):
+    """ Class for handling recording and replay of an OPUS session as a HAR file. """
+    # Attributes
+    path: Path
+    mode: Literal["record", "replay"] = "replay"
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+def _scrub_text(value: str, replacements: dict[str, str]) -> str:
+    for secret, placeholder in replacements.items():
+        value = value.replace(secret, placeholder)
+    return value
+
+def _scrub_query(url: str, secrets: dict[str, str]) -> str:
+    # Only query values that are exactly a credential are replaced, the rest of the url is kept byte for byte,
+    # so a short username does not change recorded urls that replay has to match
+    if "?" not in url:
+        return url
+    base, _, query = url.partition("?")
+    query, hash_sign, fragment = query.partition("#")
+    params = []
+    for param in query.split("&"):
+        name, equals, value = param.partition("=")
+        placeholder = secrets.get(unquote_plus(value)) if equals else None
+        params.append(f"{name}={quote_plus(placeholder)}" if placeholder else param)
+    return f"{base}?{'&'.join(params)}{hash_sign}{fragment}"
+
+def _scrub_entry(entry: dict, replacements: dict[str, str], secrets: dict[str, str]):
+    request, response = entry["request"], entry["response"]
+    for message in (request, response):
+        headers = []
+        for header in message.get("headers", []):
+            name = str(header["name"]).lower()
+            if name in SCRUBBED_HEADERS:
+                header = {**header, "value": "scrubbed"}
+            elif name in URL_HEADERS:
+                header = {**header, "value": _scrub_query(header["value"], secrets)}
+            headers.append(header)
+        message["headers"] = headers
+        message["cookies"] = [{**cookie, "value": "scrubbed"} for cookie in message.get("cookies", [])]
+    request["url"] = _scrub_query(request["url"], secrets)
+    request["queryString"] = [{**param, "value": secrets.get(param["value"], param["value"])} for param in request.get("queryString", [])]
+    post_data = request.get("postData")
+    if post_data:
+        if "text" in post_data:
+            post_data["text"] = _scrub_text(post_data["text"], replacements)
+        post_data["params"] = [{**param, "value": _scrub_text(param.get("value", ""), replacements)} for param in post_data.get("params", [])]
+    content = response.get("content")
+    if content and "text" in content and content.get("encoding") != "base64":
+        content["text"] = _scrub_text(content["text"], replacements)
+
+def scrub_har(path: Path, username: str, password: str):
+    """Replace the OPUS credentials in a recorded HAR file with placeholders and blank auth headers and cookies.
+    Credentials are replaced in post data and response bodies, and in query values that are exactly a credential.
+    Replay with SCRUBBED_USERNAME/SCRUBBED_PASSWORD, so the login request matches the recording."""
+    replacements = {}
+    secrets = {}
+    for secret, placeholder in ((password, SCRUBBED_PASSWORD), (username, SCRUBBED_USERNAME)):
+        if not secret:
+            continue
+        secrets[secret] = placeholder
+        # Form posts are url-encoded, so scrub the encoded variants as well
+        for encoded in (secret, quote(secret, safe=""), quote_plus(secret)):
+            replacements[encoded] = placeholder
+    path = Path(path)
+    har = json.loads(path.read_text(encoding="utf-8"))
+    for entry in har["log"]["entries"]:
+        _scrub_entry(entry, replacements, secrets)
+    path.write_text(json.dumps(har), encoding="utf-8")
@@ -0,0 +1,84 @@
+import csv
+import sqlite3
+from pathlib import Path
+from typing import Optional, Union
+
+MASTER_DATA_TYPES = ("Artskonto", "PSP")
+CLOSED_STATUSES = {"lukket", "spærret", "closed", "0"}
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class MasterDataIndex:
+    """ Local index of Artskonto and PSP elements, loaded from one or more exported master-data files.
+    An export is a ';' separated file with the columns Type (Artskonto/PSP), Nummer and Status.
+    Entries are stored in SQLite per export file and kept in memory, so lookups do not touch the disk.
+    An entry found in several exports is closed if any of them marks it closed. """
+    def __init__(self, db_path: Union[Path, str] = ":memory:"):
+        self._db = sqlite3.connect(str(db_path))
+        self._db.execute("CREATE TABLE IF NOT EXISTS master_data (source TEXT NOT NULL, type TEXT NOT NULL, key TEXT NOT NULL, is_open INTEGER NOT NULL, PRIMARY KEY (source, type, key)) WITHOUT ROWID")
+        self._db.execute("CREATE TABLE IF NOT EXISTS source (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL)")
+        self._db.commit()
+        self._sources: dict[str, dict[tuple[str, str], bool]] = {}
+        for source, type_, key, is_open in self._db.execute("SELECT source, type, key, is_open FROM master_data"):
+            self._sources.setdefault(source, {})[(type_, key)] = bool(is_open)
+        self._merge()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def _key(type_: str, key) -> tuple[str, str]:
+        return (type_, str(key).strip().upper())
+
+    def _merge(self):
+        entries: dict[tuple[str, str], bool] = {}
+        for source_entries in self._sources.values():
+            for key, is_open in source_entries.items():
+                entries[key] = entries.get(key, True) and is_open
+        self._entries = entries
+        self._types = {type_ for type_, _ in entries}
+
+    def refresh(self, export_file: Union[Path, str]) -> int:
+        """Load changes from the export file, returns the number of added, changed and removed entries of that file.
+        Entries from other export files are left untouched."""
+        path = Path(export_file)
+        source = str(path.resolve())
+        stat = path.stat()
+        row = self._db.execute("SELECT mtime_ns, size FROM source WHERE path = ?", (source,)).fetchone()
+        if row == (stat.st_mtime_ns, stat.st_size):
+            return 0
+
+        entries = {}
+        with open(path, newline='', encoding='utf-8-sig') as csvfile:
+            for line in csv.DictReader(csvfile, delimiter=';'):
+                type_ = line["Type"].strip()
+                if type_ not in MASTER_DATA_TYPES:
+                    raise ValueError(f"Unknown master data type '{type_}' in {path}")
+                entries[self._key(type_, line["Nummer"])] = line["Status"].strip().lower() not in CLOSED_STATUSES
+
+        previous = self._sources.get(source, {})
+        changed = [(source, type_, key, int(is_open)) for (type_, key), is_open in entries.items() if previous.get((type_, key)) != is_open]
+        removed = [(source, type_, key) for (type_, key) in previous if (type_, key) not in entries]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO master_data (source, type, key, is_open) VALUES (?, ?, ?, ?)", changed)
+            self._db.executemany("DELETE FROM master_data WHERE source = ? AND type = ? AND key = ?", removed)
+            self._db.execute("INSERT OR REPLACE INTO source (path, mtime_ns, size) VALUES (?, ?, ?)", (source, stat.st_mtime_ns, stat.st_size))
+        self._sources[source] = entries
+        self._merge()
+        return len(changed) + len(removed)
+
+    def has_type(self, type_: str) -> bool:
+        """True if any loaded export holds entries of this type (Artskonto/PSP)."""
+        return type_ in self._types
+
+    def lookup(self, type_: str, key) -> Optional[bool]:
+        """True if open, False if closed, None if not in the master data."""
+        return self._entries.get(self._key(type_, key))
+
+    def lookup_artskonto(self, artskonto: int) -> Optional[bool]:
+        return self.lookup("Artskonto", artskonto)
+
+    def lookup_psp(self, psp: str) -> Optional[bool]:
+        return self.lookup("PSP", psp)
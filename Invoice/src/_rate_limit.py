@@ -0,0 +1,128 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from pydantic import BaseModel, Field
+
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class OpusRateLimit(BaseModel):
+    """ Class for handling the client-side limits towards one OPUS user and url. """
+    # Attributes
+    logins_per_minute: float = Field(default=6.0, gt=0)
+    max_sessions: int = Field(default=2, gt=0)
+    checks_per_second: float = Field(default=1.0, gt=0)
+    adaptive: bool = True
+    slowdown_factor: float = Field(default=2.0, gt=1)         # response slower than average * factor -> slow down
+    min_rate_fraction: float = Field(default=0.25, gt=0, le=1) # never go below this part of the configured rate
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class TokenBucket:
+    """ Token bucket, acquire() blocks until a token is available. """
+    def __init__(self, rate: float, capacity: float = 1.0, clock=time.monotonic, sleep=time.sleep):
+        self._rate = rate            # tokens per second
+        self._capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """Take one token, returns the number of seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return waited
+                wait = (1.0 - self._tokens) / self._rate
+            self._sleep(wait)
+            waited += wait
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class OpusRateLimiter:
+    """ Limits logins, concurrent sessions and control checks for one OPUS user and url.
+    The limits only apply to threads in the same process. """
+    EWMA_ALPHA = 0.2
+    RATE_STEP_UP = 0.1
+
+    def __init__(self, limits: OpusRateLimit, clock=time.monotonic, sleep=time.sleep):
+        self.limits = limits
+        self._sessions = threading.BoundedSemaphore(limits.max_sessions)
+        self._logins = TokenBucket(rate=limits.logins_per_minute / 60.0, clock=clock, sleep=sleep)
+        self._checks = TokenBucket(rate=limits.checks_per_second, clock=clock, sleep=sleep)
+        self._latency: dict[str, float] = {}
+        self._rate_fraction = 1.0
+        self._lock = threading.Lock()
+
+    @property
+    def rate_fraction(self) -> float:
+        return self._rate_fraction
+
+    @contextmanager
+    def session(self):
+        self._sessions.acquire()
+        try:
+            yield
+        finally:
+            self._sessions.release()
+
+    def acquire_login(self) -> float:
+        return self._logins.acquire()
+
+    def acquire_check(self) -> float:
+        return self._checks.acquire()
+
+    def record_latency(self, kind: str, seconds: float):
+        """Record how long OPUS took to answer, slows down when answers get slower than usual."""
+        if not self.limits.adaptive:
+            return
+        with self._lock:
+            average = self._latency.get(kind)
+            if average is None:
+                self._latency[kind] = seconds
+                return
+            if seconds > average * self.limits.slowdown_factor:
+                self._rate_fraction = max(self.limits.min_rate_fraction, self._rate_fraction / 2)
+            else:
+                self._rate_fraction = min(1.0, self._rate_fraction + self.RATE_STEP_UP)
+            self._latency[kind] = average + self.EWMA_ALPHA * (seconds - average)
+            fraction = self._rate_fraction
+        self._logins.set_rate(self.limits.logins_per_minute / 60.0 * fraction)
+        self._checks.set_rate(self.limits.checks_per_second * fraction)
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+_limiters: dict[tuple[str, str], OpusRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(url: str, username: str, limits: OpusRateLimit) -> OpusRateLimiter:
+    """Return the shared limiter for an OPUS user and url, created with limits the first time.
+    Later calls get the same limiter, other limits for the same user and url are ignored with a warning."""
+    key = (url.rstrip("/").lower(), username.lower())
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = OpusRateLimiter(limits)
+        elif _limiters[key].limits != limits:
+            logging.getLogger(__name__).warning(f"Rate limits for OPUS user '{username}' at {url} are already set to {_limiters[key].limits}, ignoring {limits}")
+        return _limiters[key]
+
+def reset_rate_limiters():
+    """Forget the shared limiters, the next get_rate_limiter creates new ones. Used by the tests to start clean."""
+    with _limiters_lock:
+        _limiters.clear()
@@ -0,0 +1,167 @@
+import re
+import csv
+import json
+import time
+import sqlite3
+import hashlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Optional, Union
+from pydantic import BaseModel
+
+INPUT_HASH_EXCLUDE = {"csv_filename", "BilagsFilePath"}  # local paths, not posting data
+RESULT_FIELDS = ["timestamp", "input_hash", "reference", "status", "message", "bilag", "messages", "timings", "error"]
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+def input_hash(invoice_data: BaseModel) -> str:
+    """Hash of the posting data, the same invoice gives the same hash on every machine and run."""
+    return hashlib.sha256(invoice_data.model_dump_json(exclude=INPUT_HASH_EXCLUDE).encode("utf-8")).hexdigest()
+
+def make_record(invoice_data: BaseModel, result: Optional[dict], timings: dict[str, float], error: Optional[Exception] = None) -> dict:
+    """Build a result record for one invoice, result is the dict from nkInvoice.create_invoice."""
+    result = result or {"status": "Fejlet", "message": "Bilag ikke oprettet", "bilag": ""}
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "input_hash": input_hash(invoice_data),
+        "reference": getattr(invoice_data, "Reference", ""),
+        "status": result.get("status"),
+        "message": result.get("message"),
+        "bilag": result.get("bilag"),
+        "messages": result.get("messages", []),
+        "timings": timings,
+        "error": str(error) if error else None,
+    }
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class ResultSink(ABC):
+    """ Buffered writer of result records, records are written when the buffer is full and on close. """
+    def __init__(self, path: Union[Path, str], buffer_size: int = 100):
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self._buffer: list[dict] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, record: dict):
+        self._buffer.append(record)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._write_records(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def write_summary(self, summary: "BatchSummary"):
+        self.path.with_suffix(".summary.json").write_text(json.dumps(summary.as_dict(), indent=2, ensure_ascii=False), encoding="utf-8")
+
+    @abstractmethod
+    def _write_records(self, records: list[dict]):
+        ...
+#### ********************************************************************************************************************
+class JsonlResultSink(ResultSink):
+    def _write_records(self, records: list[dict]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+#### ********************************************************************************************************************
+class CsvResultSink(ResultSink):
+    def _write_records(self, records: list[dict]):
+        write_header = not self.path.exists() or self.path.stat().st_size == 0
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, delimiter=";")
+            if write_header:
+                writer.writeheader()
+            for record in records:
+                writer.writerow({**record, "messages": json.dumps(record["messages"], ensure_ascii=False), "timings": json.dumps(record["timings"])})
+#### ********************************************************************************************************************
+class SqliteResultSink(ResultSink):
+    def __init__(self, path: Union[Path, str], buffer_size: int = 100):
+        super().__init__(path, buffer_size)
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS results ({', '.join(RESULT_FIELDS)})")
+        self._db.commit()
+
+    def _write_records(self, records: list[dict]):
+        rows = [
+            tuple(json.dumps(record[field], ensure_ascii=False) if field in ("messages", "timings") else record[field] for field in RESULT_FIELDS)
+            for record in records
+        ]
+        with self._db:
+            self._db.executemany(f"INSERT INTO results VALUES ({', '.join('?' for _ in RESULT_FIELDS)})", rows)
+
+    def close(self):
+        super().close()
+        self._db.close()
+#### ********************************************************************************************************************
+RESULT_SINKS = {".jsonl": JsonlResultSink, ".csv": CsvResultSink, ".sqlite": SqliteResultSink, ".db": SqliteResultSink}
+
+def open_result_sink(path: Union[Path, str], buffer_size: int = 100) -> ResultSink:
+    """Open a result sink, the type is chosen from the file suffix (.jsonl, .csv, .sqlite/.db)."""
+    suffix = Path(path).suffix.lower()
+    if suffix not in RESULT_SINKS:
+        raise ValueError(f"Unsupported result file type '{suffix}', use one of {', '.join(RESULT_SINKS)}")
+    return RESULT_SINKS[suffix](path, buffer_size=buffer_size)
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+class BatchSummary:
+    """ Summary of a batch: success rate, failure categories and throughput. """
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._started = clock()
+        self._ended: Optional[float] = None
+        self.total = 0
+        self.succeeded = 0
+        self.failures: Counter[str] = Counter()
+
+    @staticmethod
+    def failure_category(record: dict) -> str:
+        if record.get("error"):
+            return "Login fejlet" if "Login failed" in record["error"] else "Teknisk fejl"
+        # Numbers (accounts, PSP, amounts) are removed, so the same OPUS message falls in the same category
+        return re.sub(r"\d+", "#", record.get("bilag") or "Ukendt")
+
+    def add(self, record: dict):
+        self.total += 1
+        if record["status"] == "Succes":
+            self.succeeded += 1
+        else:
+            self.failures[self.failure_category(record)] += 1
+
+    def finish(self):
+        self._ended = self._clock()
+
+    @property
+    def elapsed(self) -> float:
+        return (self._ended if self._ended is not None else self._clock()) - self._started
+
+    @property
+    def success_rate(self) -> float:
+        return self.succeeded / self.total if self.total else 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Invoices per minute."""
+        return self.total / self.elapsed * 60 if self.elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "succeeded": self.succeeded,
+            "failed": self.total - self.succeeded,
+            "success_rate": self.success_rate,
+            "failure_categories": dict(self.failures.most_common()),
+            "elapsed_seconds": self.elapsed,
+            "invoices_per_minute": self.throughput,
+        }
+
+    def __str__(self) -> str:
+        return f"{self.succeeded}/{self.total} succeeded ({self.success_rate:.0%}), {self.throughput:.1f} invoices/min, failures: {dict(self.failures.most_common())}"
@@ -3,11 +3,19 @@ import csv
 import sys
 from pathlib import Path
 from playwright.sync_api import Playwright, sync_playwright, expect
-from playwright.sync_api import Browser, BrowserContext, Page
+from playwright.sync_api import Browser, BrowserContext, Page, FilePayload, TimeoutError as PlaywrightTimeoutError
 # from setup.Constants import Constants
 from pydantic import BaseModel, Field, ValidationError, computed_field, ConfigDict, PrivateAttr, field_validator, model_validator, constr, FilePath, ValidationInfo, confloat
-from typing import Optional, Union
+from typing import Iterable, NamedTuple, Optional, Union
 from Invoice.src._helpers import _exception_helper
+from Invoice.src._rate_limit import OpusRateLimit, OpusRateLimiter, get_rate_limiter
+from Invoice.src._master_data import MasterDataIndex
+from Invoice.src._har import HarConfig, scrub_har
+from Invoice.src._results import ResultSink, BatchSummary, make_record, open_result_sink
+import time
+import mimetypes
+import threading
+from contextlib import contextmanager
 import logging
 from enum import Enum, auto
 
@@ -23,6 +31,10 @@ IFRAME_SELECTORS = [
                 'iframe[name*="work"]',
                 'iframe:visible'
             ]
+LOGIN_TIMEOUT = 30000  # ms to wait for the portal or a login error after "Sign in"
+CHECK_WAIT = 2000      # ms to give SAP for "Kontroller bilag" before reading the control messages
+CHECK_TIMEOUT = 10000  # ms to wait for the control messages to change after "Kontroller bilag"
+CHECK_POLL = 100       # ms between reads of the control messages
 #### ********************************************************************************************************************
 #### ********************************************************************************************************************
 class LogLevel(Enum):
@@ -43,10 +55,67 @@ class OpusConfig(BaseModel):
     municipality_code: int  # required
     username: str           # required
     password: str           # required
+    rate_limit: OpusRateLimit = Field(default_factory=OpusRateLimit)  # shared per user and url, the first config in the process sets the limits
 
     def valid_url(self) -> str:
         base_url = self.url.rstrip("/")
         return f"{base_url}/?kommune={self.municipality_code}"
+
+    def rate_limiter(self) -> OpusRateLimiter:
+        return get_rate_limiter(url=self.url, username=self.username, limits=self.rate_limit)
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+####
+_profile_dirs_in_use: set[Path] = set()
+_profile_dirs_lock = threading.Lock()
+
+class LaunchProfile(BaseModel):
+    """ Class for handling how Chromium is launched for an OPUS session. """
+    # Attributes
+    headless: Optional[bool] = None         # None -> use nkInvoice._headless
+    headless_shell: bool = True             # use the lightweight chromium-headless-shell when headless
+    disable_gpu: bool = False
+    disable_extensions: bool = False
+    disable_background_networking: bool = False
+    user_data_dir: Optional[Path] = None    # reused between runs -> persistent context, one subdirectory per session
+
+    def launch_args(self) -> list[str]:
+        args = []
+        if self.disable_gpu:
+            args.append("--disable-gpu")
+        if self.disable_extensions:
+            args.append("--disable-extensions")
+        if self.disable_background_networking:
+            args.append("--disable-background-networking")
+            args.append("--disable-component-update")
+            args.append("--disable-sync")
+        return args
+
+    def channel(self, headless: bool) -> Optional[str]:
+        # Playwright uses chromium-headless-shell for headless runs unless the full "chromium" channel is requested
+        if headless and not self.headless_shell:
+            return "chromium"
+        return None
+
+    @property
+    def persistent_context(self) -> bool:
+        return self.user_data_dir is not None
+
+    def claim_user_data_dir(self) -> Path:
+        """Claim a free session directory (session-1, session-2, ...) below user_data_dir.
+        Chromium will not start twice on the same profile, so parallel sessions in the process each get their own.
+        The directories are kept, so later runs start warm."""
+        with _profile_dirs_lock:
+            slot = 1
+            while (path := Path(self.user_data_dir) / f"session-{slot}") in _profile_dirs_in_use:
+                slot += 1
+            _profile_dirs_in_use.add(path)
+        return path
+
+    @staticmethod
+    def release_user_data_dir(path: Path):
+        with _profile_dirs_lock:
+            _profile_dirs_in_use.discard(path)
 #### ********************************************************************************************************************
 #### ********************************************************************************************************************
 ####
@@ -100,6 +169,13 @@ class InvoiceData(BaseModel):
         
 #### ********************************************************************************************************************
 #### ********************************************************************************************************************
+class PreparedVoucher(NamedTuple):
+    """ A voucher form open in a tab with its attachment read, or the error that stopped preparing it. """
+    page: Optional[Page] = None
+    attachment: Optional[FilePayload] = None
+    error: Optional[str] = None
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
 class nkInvoice(BaseModel):
     """ Class for handling invoices and interactions with the Opus system. """    
     # Private attributes
@@ -107,11 +183,22 @@ class nkInvoice(BaseModel):
     _context: Optional[BrowserContext] = PrivateAttr(default=None)
     _page: Optional[Page] = PrivateAttr(default=None)
     _result: Optional[dict] = PrivateAttr(default=None)
+    _rate_limiter: Optional[OpusRateLimiter] = PrivateAttr(default=None)
+    _timings: dict[str, float] = PrivateAttr(default_factory=dict)
+    _control_messages: list[str] = PrivateAttr(default_factory=list)
+    _attachment: Optional[FilePayload] = PrivateAttr(default=None)
+    _portal_url: Optional[str] = PrivateAttr(default=None)
+    _check_started: float = PrivateAttr(default=0.0)
+    _check_messages_before: list[str] = PrivateAttr(default_factory=list)
+    _user_data_dir: Optional[Path] = PrivateAttr(default=None)
 
     # Attributes
-    model_config = ConfigDict(extra='forbid', strict=True)
+    model_config = ConfigDict(extra='forbid', strict=True, arbitrary_types_allowed=True)
     invoice_data: InvoiceData
     opus_data: OpusConfig
+    launch_profile: LaunchProfile = Field(default_factory=LaunchProfile)
+    har: Optional[HarConfig] = None
+    master_data: Optional[MasterDataIndex] = None
     _headless: bool = False
     _verbose: bool = False    
     _logger: logging.Logger = None
@@ -124,14 +211,94 @@ class nkInvoice(BaseModel):
         self._log_verbose(message="****************************************************************************")
         self._log_verbose(message="****************************************************************************")
         self._log(message="Start creation of invoice", level=LogLevel.INFO)
-        with sync_playwright() as playwright:
-            self._create_csv()
-            self._start_opus_rollebaseret(playwright)
-            self._fill_opus_page()
-            self._context.close()
-            self._browser.close()
-            self._log(message="End creation of invoice", level=LogLevel.INFO)
+        self._timings = {}
+        self._control_messages = []
+        self._attachment = None
+        errors = self._check_master_data()
+        if errors:
+            self._result = {"status": "Fejlet", "message": "Bilag ikke oprettet", "bilag": "; ".join(errors), "messages": errors}
+            self._log(message=f"Invoice rejected by master data: {self._result}", level=LogLevel.WARNING)
             return self._result
+        with self._timed("total"):
+            self._rate_limiter = self.opus_data.rate_limiter()
+            self._create_csv()
+            with self._rate_limiter.session(), sync_playwright() as playwright:
+                try:
+                    with self._timed("start_opus"):
+                        self._start_opus_rollebaseret(playwright)
+                    with self._timed("fill_opus_page"):
+                        self._fill_opus_page()
+                finally:
+                    # Also on errors, so a recorded HAR file is always written and scrubbed
+                    self._close_browser()
+        self._log_verbose(message=f"Timings: {self._timings}")
+        self._log(message="End creation of invoice", level=LogLevel.INFO)
+        return self._result
+
+    def create_invoices(self, invoices: list[InvoiceData]) -> list[dict]:
+        """Create several invoices in one OPUS session, returns a result per invoice in the same order.
+        While SAP checks a voucher, the next one is prepared in a second tab: CSV written, attachment read and
+        "Opret omposteringsbilag" open. Errors on one voucher, also while preparing it, are returned in its result
+        under "error" and the session goes on with the next voucher. A failed login raises like create_invoice."""
+        self._log(message=f"Start creation of {len(invoices)} invoices", level=LogLevel.INFO)
+        results: list[Optional[dict]] = [None] * len(invoices)
+        original = self.invoice_data
+        try:
+            pending = []
+            for i, invoice_data in enumerate(invoices):
+                self.invoice_data = invoice_data
+                errors = self._check_master_data()
+                if errors:
+                    results[i] = {"status": "Fejlet", "message": "Bilag ikke oprettet", "bilag": "; ".join(errors), "messages": errors}
+                else:
+                    pending.append(i)
+            if not pending:
+                return results
+
+            self._rate_limiter = self.opus_data.rate_limiter()
+            with self._rate_limiter.session(), sync_playwright() as playwright:
+                try:
+                    self.invoice_data = invoices[pending[0]]
+                    self._start_opus_rollebaseret(playwright)
+                    ready = self._try_prepare_voucher(invoices[pending[0]], page=self._page)
+                    for n, i in enumerate(pending):
+                        next_data = invoices[pending[n + 1]] if n + 1 < len(pending) else None
+                        self.invoice_data = invoices[i]
+                        self._timings = {}
+                        self._control_messages = []
+                        if ready.error:
+                            # The form or files for this voucher could not be prepared
+                            results[i] = self._error_result(ready.error)
+                            ready = self._try_prepare_voucher(next_data) if next_data is not None else None
+                            continue
+                        page, self._attachment = ready.page, ready.attachment
+                        self._page = page
+                        next_ready = None
+                        try:
+                            self._fill_voucher()
+                            self._start_check()
+                        except Exception as e:
+                            results[i] = self._error_result(e)
+                        else:
+                            # SAP is checking this voucher, use the time to get the next one ready
+                            if next_data is not None:
+                                next_ready = self._try_prepare_voucher(next_data)
+                            try:
+                                results[i] = self._voucher_result(self._read_check())
+                            except Exception as e:
+                                results[i] = self._error_result(e)
+                        self._close_page(page)
+                        # Not prepared yet, or preparing failed while SAP was checking: try once more in a new tab
+                        if next_data is not None and (next_ready is None or next_ready.error):
+                            next_ready = self._try_prepare_voucher(next_data)
+                        ready = next_ready
+                finally:
+                    self._close_browser()
+        finally:
+            self.invoice_data = original
+            self._attachment = None
+        self._log(message="End creation of invoices", level=LogLevel.INFO)
+        return results
     ### ------------------------------------------------------------------------------------------------------
     ### PRIVATE METHODS
     def verbose_log_frames(self):
@@ -141,6 +308,14 @@ class nkInvoice(BaseModel):
             for i, frame in enumerate(frames):
                 self._log(message=f"Frame {i}: name='{frame.name}'", level=LogLevel.DEBUG)
                 
+    @contextmanager
+    def _timed(self, step: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timings[step] = time.perf_counter() - start
+
     def _log_verbose(self, message: str):
         if self._verbose:
             self._log(message=message, level=LogLevel.DEBUG)
@@ -163,10 +338,17 @@ class nkInvoice(BaseModel):
     @_exception_helper
     def _fill_opus_page(self):
         # Fill the OPUS page with invoice data
+        self._fill_voucher()
+        # Kontroller bilag
+        status_text = self._check_invoice()
+        # Opret bilag
+        self._result = self._voucher_result(status_text)
+        self._log_verbose(message=f"End filling data in OPUS page with result: {self._result}")
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _fill_voucher(self):
         self._log(message="Start filling data in OPUS page", level=LogLevel.INFO)
-        Invoice = "Fejlet"
-        status_text = "Ikke afviklet"
-        text = "Ikke afviklet"
         # Wait for page to load
         self._log_verbose(message="Waiting for OPUS page to load")
         self._page.wait_for_load_state('networkidle')
@@ -182,8 +364,9 @@ class nkInvoice(BaseModel):
         self._fill_attachment()
         # Indsæt csv posteringer
         self._fill_csv()
-        # Kontroller bilag
-        status_text = self._check_invoice()
+    ### ***********************************************************
+    ### ***********************************************************
+    def _voucher_result(self, status_text: str) -> dict:
         self._log_verbose(message=f"Status text after checking invoice: {status_text}")
         if status_text == 'Omposteringsbilaget er kontrolleret og OK':
             Invoice = "Succes"
@@ -191,18 +374,13 @@ class nkInvoice(BaseModel):
         else:
             Invoice = "Fejlet"
             text = "Bilag ikke oprettet"
-        # Opret bilag
-        self._result = {"status": Invoice, "message": text, "bilag": status_text}
-        self._log_verbose(message=f"End filling data in OPUS page with result: {self._result}")
+        return {"status": Invoice, "message": text, "bilag": status_text, "messages": self._control_messages}
     ### ***********************************************************
     ### ***********************************************************
     def check_login_error(self):
-        # Wait until the form is visible (ensures DOM is loaded)
+        # Read the login error message, if the login form is showing one
         try:
             self._log_verbose(message="Checking for login error messages")
-            self._page.wait_for_selector("#loginForm", timeout=2000)
-
-            # Check if error element exists and is visible
             error_locator = self._page.locator("#errorText")
 
             if error_locator.is_visible():
@@ -210,6 +388,7 @@ class nkInvoice(BaseModel):
                 self._log_verbose(message=f"Login error message found: {error_message}")
                 return error_message
             else:
+                self._log_verbose(message="No login error message found")
                 return None            
         except:
             self._log_verbose(message="No login error message found")
@@ -217,29 +396,184 @@ class nkInvoice(BaseModel):
     ### ***********************************************************
     ### ***********************************************************
     @_exception_helper
+    def _launch_browser(self, playwright):
+        profile = self.launch_profile
+        headless = self._headless if profile.headless is None else profile.headless
+        args = profile.launch_args()
+        channel = profile.channel(headless)
+        self._log_verbose(message=f"Launching Chromium: headless={headless}, channel={channel}, args={args}, user_data_dir={profile.user_data_dir}")
+        context_options = {}
+        if self.har and self.har.mode == "record":
+            self._log_verbose(message=f"Recording session to HAR file: {self.har.path}")
+            context_options = {"record_har_path": str(self.har.path), "record_har_content": "embed"}
+        if profile.persistent_context:
+            # A persistent context keeps the disk cache between runs, so warm launches load OPUS faster
+            self._browser = None
+            self._user_data_dir = profile.claim_user_data_dir()
+            self._log_verbose(message=f"Using Chromium profile {self._user_data_dir}")
+            self._context = playwright.chromium.launch_persistent_context(str(self._user_data_dir), headless=headless, channel=channel, args=args, **context_options)
+            self._page = self._context.pages[0] if self._context.pages else self._context.new_page()
+        else:
+            self._browser = playwright.chromium.launch(headless=headless, channel=channel, args=args)
+            self._context = self._browser.new_context(**context_options)
+            self._page = self._context.new_page()
+        if self.har and self.har.mode == "replay":
+            # Serve every request from the HAR file, anything not recorded is aborted so OPUS is never contacted
+            self._log_verbose(message=f"Replaying session from HAR file: {self.har.path}")
+            self._context.route_from_har(self.har.path, not_found="abort")
+    ### ***********************************************************
+    ### ***********************************************************
+    def _close_browser(self):
+        try:
+            if self._context:
+                try:
+                    self._context.close()
+                finally:
+                    # The HAR file is written when the context closes
+                    if self.har and self.har.mode == "record" and Path(self.har.path).exists():
+                        scrub_har(self.har.path, username=self.opus_data.username, password=self.opus_data.password)
+            if self._browser:
+                self._browser.close()
+        finally:
+            if self._user_data_dir:
+                LaunchProfile.release_user_data_dir(self._user_data_dir)
+            self._context = None
+            self._browser = None
+            self._user_data_dir = None
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
     def _start_opus_rollebaseret(self, playwright)-> tuple[Browser, BrowserContext, Page]:
-        self._browser = playwright.chromium.launch(headless=self._headless)
-        self._context = self._browser.new_context()
-        self._page = self._context.new_page()
+        self._launch_browser(playwright)
+        waited = self._rate_limiter.acquire_login()
+        self._log_verbose(message=f"Login rate limit waited {waited:.2f} s")
+        with self._timed("login"):
+            self._login()
+        self._rate_limiter.record_latency("login", self._timings["login"])
+        self._portal_url = self._page.url
+        self._open_voucher_form(self._page)
+    ### ***********************************************************
+    ### ***********************************************************
+    def _open_voucher_form(self, page: Page):
+        page.locator("#externalCol").get_by_role("button").click()
+        page.get_by_text("Bilagsbehandling").click()
+        page.get_by_text("Opret omposteringsbilag").click()
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _prepare_voucher(self) -> Optional[FilePayload]:
+        """Write the CSV and read the attachment of the current invoice, so the upload does not wait on disk."""
+        self._create_csv()
+        if self.invoice_data.BilagsFilePath is None or len(str(self.invoice_data.BilagsFilePath)) == 0:
+            return None
+        path = Path(self.invoice_data.BilagsFilePath)
+        mime_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        return {"name": path.name, "mimeType": mime_type, "buffer": path.read_bytes()}
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _prepare_next_voucher(self, invoice_data: InvoiceData, page: Optional[Page] = None) -> PreparedVoucher:
+        """Open a blank voucher form in a second tab of the logged-in context, with the CSV of the next invoice ready.
+        A page that is already on the voucher form can be given instead. On errors the tab is closed."""
+        self._log_verbose(message="Preparing next voucher in a second tab")
+        current = self.invoice_data
+        try:
+            self.invoice_data = invoice_data
+            try:
+                attachment = self._prepare_voucher()
+            finally:
+                self.invoice_data = current
+            if page is None:
+                page = self._context.new_page()
+                page.goto(self._portal_url)
+                self._open_voucher_form(page)
+        except Exception:
+            if page is not None:
+                self._close_page(page)
+            raise
+        return PreparedVoucher(page=page, attachment=attachment)
+    ### ***********************************************************
+    ### ***********************************************************
+    def _try_prepare_voucher(self, invoice_data: InvoiceData, page: Optional[Page] = None) -> PreparedVoucher:
+        # The error is kept with the voucher being prepared, not with the voucher SAP is checking meanwhile
+        try:
+            return self._prepare_next_voucher(invoice_data, page=page)
+        except Exception as e:
+            self._log(message=f"Preparing voucher failed: {e}", level=LogLevel.ERROR)
+            return PreparedVoucher(error=str(e))
+    ### ***********************************************************
+    ### ***********************************************************
+    def _close_page(self, page: Page):
+        try:
+            page.close()
+        except Exception as e:
+            self._log(message=f"Closing page failed: {e}", level=LogLevel.WARNING)
+    ### ***********************************************************
+    ### ***********************************************************
+    def _error_result(self, error: Union[Exception, str]) -> dict:
+        self._log(message=f"Invoice failed: {error}", level=LogLevel.ERROR)
+        return {"status": "Fejlet", "message": "Bilag ikke oprettet", "bilag": "", "messages": self._control_messages, "error": str(error)}
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _login(self):
         url = self.opus_data.valid_url()
         self._page.goto(url)
-        self._page.get_by_role("textbox", name="User Account").fill(self.opus_data.username)
+        portal = self._page.locator("#externalCol")
+        user_account = self._page.get_by_role("textbox", name="User Account")
+        # A reused Chromium profile can still hold a valid OPUS/ADFS login, then the portal shows up without a login form
+        try:
+            portal.or_(user_account).first.wait_for(state="visible", timeout=LOGIN_TIMEOUT)
+        except PlaywrightTimeoutError:
+            raise RuntimeError(f"Login failed: no login form or portal from OPUS within {LOGIN_TIMEOUT / 1000:.0f} s")
+        if portal.is_visible():
+            self._log_verbose(message="Already logged in, reusing the login of the Chromium profile")
+            return
+        user_account.fill(self.opus_data.username)
         self._page.get_by_role("textbox", name="Password").fill(self.opus_data.password)
         self._page.get_by_role("button", name="Sign in").click()
-        
+
+        # Race the portal against the login error, login is done as soon as one of them shows up
+        error = self._page.locator("#errorText").filter(visible=True)
         try:
-            self._log_verbose(message="Waiting for network to be idle after login")
-            self._page.wait_for_load_state('networkidle', timeout=10000)
-        except:
-            pass
-        
+            self._log_verbose(message="Waiting for portal or login error after login")
+            portal.or_(error).first.wait_for(state="visible", timeout=LOGIN_TIMEOUT)
+        except PlaywrightTimeoutError:
+            raise RuntimeError(f"Login failed: no response from OPUS within {LOGIN_TIMEOUT / 1000:.0f} s")
+
+        if portal.is_visible():
+            self._log_verbose(message="Login succeeded")
+            return
+
         error_message = self.check_login_error()
-        if error_message:
-            raise RuntimeError(f"Login failed: {error_message}")
-        
-        self._page.locator("#externalCol").get_by_role("button").click()
-        self._page.get_by_text("Bilagsbehandling").click()
-        self._page.get_by_text("Opret omposteringsbilag").click()
+        raise RuntimeError(f"Login failed: {error_message}")
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _check_master_data(self) -> list[str]:
+        """Check Artskonto and PSP against the local master data, before spending an OPUS session."""
+        if self.master_data is None:
+            return []
+        self._log_verbose(message="Checking Artskonto and PSP against master data")
+        checks = [
+            ("Artskonto", "Debet_Artskonto", self.invoice_data.Debet_Artskonto),
+            ("Artskonto", "Kredit_Artskonto", self.invoice_data.Kredit_Artskonto),
+            ("PSP", "Debet_PSP", self.invoice_data.Debet_PSP),
+            ("PSP", "Kredit_PSP", self.invoice_data.Kredit_PSP),
+        ]
+        errors = []
+        for type_, field, value in checks:
+            if value is None or len(str(value).strip()) == 0:
+                continue
+            is_open = self.master_data.lookup(type_, value)
+            if is_open is None:
+                # Without any entries of this type there is nothing to check against
+                if not self.master_data.has_type(type_):
+                    continue
+                errors.append(f"{field} {value} findes ikke i stamdata")
+            elif not is_open:
+                errors.append(f"{field} {value} er lukket")
+        return errors
     ### ***********************************************************
     ### ***********************************************************
     @_exception_helper
@@ -334,8 +668,8 @@ class nkInvoice(BaseModel):
     ### ***********************************************************
     ### ***********************************************************
     @_exception_helper
-    def _upload_file(self, locator:str, file_path: str):
-        self._log(message=f"Uploading file:{file_path}", level=LogLevel.INFO)
+    def _upload_file(self, locator:str, file_path: Union[str, FilePayload]):
+        self._log(message=f"Uploading file:{file_path['name'] if isinstance(file_path, dict) else file_path}", level=LogLevel.INFO)
         """Handle file attachment in popup window"""
         # Click the attachment button
         self._log_verbose(message=f"Uploading file using locator: {locator}")
@@ -396,7 +730,7 @@ class nkInvoice(BaseModel):
         if self.invoice_data.BilagsFilePath is None or len(str(self.invoice_data.BilagsFilePath)) == 0:
             self._log_verbose(message="No attachment file path provided, skipping attachment step")
             return
-        self._upload_file(locator='div[title="Vedhæft et nyt dokument"]', file_path=str(self.invoice_data.BilagsFilePath))
+        self._upload_file(locator='div[title="Vedhæft et nyt dokument"]', file_path=self._attachment or str(self.invoice_data.BilagsFilePath))
         self._log_verbose(message="Attachment process completed")
     ### ***********************************************************
     ### ***********************************************************
@@ -412,8 +746,8 @@ class nkInvoice(BaseModel):
     def _get_status_text(self, frame)->str:
         self._log(message="Getting status text after invoice check", level=LogLevel.INFO)
         status_text= 'Not controlled'
-        message_area = frame.locator("table.lsHTMLContainer.lsScrollContainer--positionscrolling")
-        messages = message_area.locator("span.lsTextView").all_text_contents()
+        messages = self._control_message_locator(frame).all_text_contents()
+        self._control_messages = messages
         if len(messages) > 0:
             status_text = messages[0]
             
@@ -421,18 +755,79 @@ class nkInvoice(BaseModel):
         return status_text
     ### ***********************************************************
     ### ***********************************************************
+    def _control_message_locator(self, frame):
+        message_area = frame.locator("table.lsHTMLContainer.lsScrollContainer--positionscrolling")
+        return message_area.locator("span.lsTextView")
+    ### ***********************************************************
+    ### ***********************************************************
     @_exception_helper
     def _check_invoice(self)->bool:
+        self._start_check()
+        return self._read_check()
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _start_check(self):
         self._log(message="Checking invoice", level=LogLevel.INFO)
         frame = self._page.frame_locator("#contentAreaFrame").frame_locator("#isolatedWorkArea")
         control_button = frame.locator('div[title*="Kontroller bilag"]')
+        waited = self._rate_limiter.acquire_check()
+        self._log_verbose(message=f"Control check rate limit waited {waited:.2f} s")
+        # Remember the messages before the click, so the answer from SAP can be recognised
+        self._check_messages_before = self._control_message_locator(frame).all_text_contents()
         self._log_verbose(message="Clicking control button")
+        self._check_started = time.perf_counter()
         control_button.click()
+    ### ***********************************************************
+    ### ***********************************************************
+    @_exception_helper
+    def _read_check(self)->str:
+        frame = self._page.frame_locator("#contentAreaFrame").frame_locator("#isolatedWorkArea")
+        messages = self._control_message_locator(frame)
+        # Wait until SAP has answered, i.e. the control messages have changed since the click
         self._log_verbose(message="Waiting for control to complete")
-        self._page.wait_for_timeout(2000)
+        polled = False
+        while True:
+            current = messages.all_text_contents()
+            elapsed = (time.perf_counter() - self._check_started) * 1000
+            if current and current != self._check_messages_before:
+                # Only a change seen while polling tells how fast SAP answered, work done since the click
+                # (e.g. preparing the next voucher) may have hidden the real answer time
+                if polled:
+                    self._rate_limiter.record_latency("check", elapsed / 1000)
+                break
+            if elapsed >= CHECK_TIMEOUT:
+                # Empty or the same messages as before the click, not an answer time
+                self._log(message=f"Control messages did not change within {CHECK_TIMEOUT / 1000:.0f} s, reading them as they are", level=LogLevel.WARNING)
+                break
+            polled = True
+            self._page.wait_for_timeout(CHECK_POLL)
+        # Work done since the click counts towards the wait
+        remaining = CHECK_WAIT - (time.perf_counter() - self._check_started) * 1000
+        if remaining > 0:
+            self._page.wait_for_timeout(remaining)
         status_text = self._get_status_text(frame)
+        self._timings["check_invoice"] = time.perf_counter() - self._check_started
         return  status_text
     ### ***********************************************************
     ### ***********************************************************
-
-
+#### ********************************************************************************************************************
+#### ********************************************************************************************************************
+def run_batch(invoices: Iterable[nkInvoice], sink: ResultSink) -> BatchSummary:
+    """Create the invoices one by one, writing a result record per invoice to the sink.
+    Errors are recorded instead of stopping the batch. Returns the batch summary, which is also written next to the sink file."""
+    summary = BatchSummary()
+    with sink:
+        for invoice in invoices:
+            result, error = None, None
+            try:
+                result = invoice.create_invoice()
+            except Exception as e:
+                error = e
+                invoice._log(message=f"Invoice failed: {e}", level=LogLevel.ERROR)
+            record = make_record(invoice.invoice_data, result, invoice._timings, error)
+            sink.write(record)
+            summary.add(record)
+        summary.finish()
+        sink.write_summary(summary)
+    return summary
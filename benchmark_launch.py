@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+from dotenv import load_dotenv
+from playwright.sync_api import sync_playwright
+from Invoice.src.nkInvoice import nkInvoice, LaunchProfile
+load_dotenv()
+## Benchmark of Chromium launch profiles
+## Reports first and repeated launch-to-login time for each profile, so the fastest configuration can be chosen per server.
+## First: the first launch in a fresh Python process, i.e. new Playwright driver and new browser process. Each profile runs
+## in its own process, but the OS file cache (e.g. the browser binary) may still be warm from the profiles before it.
+## Repeated: the following launches in the same process. Only the persistent-context profile reuses its user-data
+## directory and disk cache, the other profiles start a new browser with an empty context every time.
+RUNS_REPEATED = 3
+LEAN = {"headless": True, "disable_gpu": True, "disable_extensions": True, "disable_background_networking": True}
+PROFILES = {
+    "default (headless)": {"headless": True},
+    "headless, full chromium": {"headless": True, "headless_shell": False},
+    "lean": LEAN,
+    "lean + persistent context": {**LEAN, "user_data_dir": True},
+}
+
+def launch_to_login(invoice: nkInvoice) -> float:
+    # Go through the shared login limit, the benchmark logs in many times with the same user
+    invoice.opus_data.rate_limiter().acquire_login()
+    with sync_playwright() as playwright:
+        try:
+            start = time.perf_counter()
+            invoice._launch_browser(playwright)
+            invoice._login()
+            elapsed = time.perf_counter() - start
+        finally:
+            invoice._close_browser()
+    return elapsed
+
+def benchmark_profile(name: str, profile: LaunchProfile, opus_data: dict, invoice_data: dict) -> dict:
+    invoice = nkInvoice(opus_data=opus_data, invoice_data=invoice_data, launch_profile=profile)
+    first = launch_to_login(invoice)
+    repeated = [launch_to_login(invoice) for _ in range(RUNS_REPEATED)]
+    return {"profile": name, "first": first, "repeated": min(repeated), "repeated_avg": sum(repeated) / len(repeated)}
+
+def run_in_subprocess(name: str, user_data_dir: Path) -> dict:
+    process = subprocess.run([sys.executable, __file__, name, str(user_data_dir)], capture_output=True, text=True)
+    if process.returncode != 0:
+        return {"profile": name, "error": (process.stderr.strip().splitlines() or ["unknown error"])[-1]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    ## Load environment variables
+    opus_data = {
+        "url": os.getenv('OPUS_URL'),
+        "municipality_code": int(os.getenv('OPUS_MUNICIPALITY_CODE')),
+        "username": os.getenv('OPUS_USER'),
+        "password": os.getenv('OPUS_USER_PASSWORD')
+    }
+    # Only used to construct nkInvoice, nothing is created in OPUS
+    invoice_data = {
+        "Tekst": "Benchmark",
+        "Debet_Artskonto": 40000000,
+        "Kredit_Artskonto": 40000000,
+        "Kost": 1.0,
+        "csv_filename": Path(tempfile.gettempdir()) / "opus_benchmark.csv"
+    }
+    if len(sys.argv) == 3:
+        ## Child process: benchmark one profile and print the result as JSON
+        name, user_data_dir = sys.argv[1], Path(sys.argv[2])
+        settings = dict(PROFILES[name])
+        if settings.pop("user_data_dir", False):
+            settings["user_data_dir"] = user_data_dir
+        print(json.dumps(benchmark_profile(name, LaunchProfile(**settings), opus_data, invoice_data)))
+        sys.exit(0)
+
+    user_data_dir = Path(tempfile.mkdtemp(prefix="nkinvoice-profile-"))
+    try:
+        results = [run_in_subprocess(name, user_data_dir) for name in PROFILES]
+    finally:
+        shutil.rmtree(user_data_dir, ignore_errors=True)
+
+    print(f"{'Profile':<30}{'First (s)':>11}{'Repeated (s)':>14}{'Repeated avg (s)':>18}")
+    for result in sorted(results, key=lambda r: r.get("repeated", float("inf"))):
+        if "error" in result:
+            print(f"{result['profile']:<30}  failed: {result['error']}")
+            continue
+        print(f"{result['profile']:<30}{result['first']:>11.2f}{result['repeated']:>14.2f}{result['repeated_avg']:>18.2f}")
@@ -1,5 +1,6 @@
 import unittest
-from Invoice.src.nkInvoice import nkInvoice, OpusConfig
+from Invoice.src.nkInvoice import nkInvoice, OpusConfig, LaunchProfile
+from Invoice.src._rate_limit import reset_rate_limiters
 from pydantic import ValidationError
 import os
 from dotenv import load_dotenv
@@ -8,6 +9,7 @@ from datetime import date
 class TestInvoice(unittest.TestCase):
     def setUp(self):
         # Setup code: create resources needed for tests
+        reset_rate_limiters()
         self.invoice_data = {
             "Debet_PSP":"XG-0000000204-00001",
             "Kredit_PSP":"XG-0000002473-00029",
@@ -192,6 +194,35 @@ class TestInvoice(unittest.TestCase):
             except Exception as e:
                 self.assertTrue("Input should be greater than 0 ".lower() in str(e).lower())  
     # *************************************************************************************************************
+    def test_launch_profile(self):
+        # Default profile keeps the old behaviour: no extra args and headless decided by nkInvoice._headless
+        profile = LaunchProfile()
+        self.assertEqual(profile.launch_args(), [])
+        self.assertIsNone(profile.headless)
+        self.assertIsNone(profile.channel(headless=True))
+        self.assertFalse(profile.persistent_context)
+        # Lean profile
+        profile = LaunchProfile(headless=True, headless_shell=False, disable_gpu=True, disable_extensions=True, disable_background_networking=True, user_data_dir="/tmp/nkinvoice-profile")
+        self.assertIn("--disable-gpu", profile.launch_args())
+        self.assertIn("--disable-extensions", profile.launch_args())
+        self.assertIn("--disable-background-networking", profile.launch_args())
+        self.assertEqual(profile.channel(headless=True), "chromium")
+        self.assertIsNone(profile.channel(headless=False))
+        self.assertTrue(profile.persistent_context)
+        # Parallel sessions get their own Chromium profile below user_data_dir, a released one is reused
+        first = profile.claim_user_data_dir()
+        second = profile.claim_user_data_dir()
+        self.assertEqual(first.name, "session-1")
+        self.assertEqual(second.name, "session-2")
+        LaunchProfile.release_user_data_dir(first)
+        self.assertEqual(profile.claim_user_data_dir(), first)
+        LaunchProfile.release_user_data_dir(first)
+        LaunchProfile.release_user_data_dir(second)
+        # Profile can be given to nkInvoice
+        opus = OpusConfig(url=self.opus_url, municipality_code=self.opus_municipality_code, username="bruger", password="kode1234")
+        invoice = nkInvoice(opus_data=opus, invoice_data=self.invoice_data, launch_profile=profile)
+        self.assertTrue(invoice.launch_profile.disable_gpu)
+    # *************************************************************************************************************
     def test_invoice_creation_login(self):
         try:
             opus = OpusConfig(url=self.opus_url, municipality_code=self.opus_municipality_code, username="bruger", password="kode1234")
@@ -0,0 +1,141 @@
+import os
+import unittest
+import tempfile
+from pathlib import Path
+from Invoice.src._master_data import MasterDataIndex
+from Invoice.src._rate_limit import reset_rate_limiters
+from Invoice.src.nkInvoice import nkInvoice
+from fakes import opus_config
+
+class TestMasterData(unittest.TestCase):
+    def setUp(self):
+        reset_rate_limiters()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.export_file = Path(self.tmp.name) / "stamdata.csv"
+        self.db_path = Path(self.tmp.name) / "stamdata.sqlite"
+        self._write_export([
+            ("Artskonto", "40000000", "Åben"),
+            ("Artskonto", "40000001", "Lukket"),
+            ("PSP", "XG-0000000204-00001", "Åben"),
+            ("PSP", "XG-0000002473-00029", "Åben"),
+        ])
+        self.invoice_data = {
+            "Debet_PSP":"XG-0000000204-00001",
+            "Kredit_PSP":"XG-0000002473-00029",
+            "Tekst":"Test af tekst",
+            "Debet_Artskonto":40000000,
+            "Kredit_Artskonto":40000000,
+            "Kost":1.0,
+            "csv_filename":Path(self.tmp.name) / "opus.csv"
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write_export(self, rows, mtime_ns=None):
+        with open(self.export_file, "w", encoding="utf-8") as f:
+            f.write("Type;Nummer;Status\n")
+            for row in rows:
+                f.write(";".join(row) + "\n")
+        if mtime_ns:
+            os.utime(self.export_file, ns=(mtime_ns, mtime_ns))
+
+    def _invoice(self, index, **changes):
+        data = self.invoice_data.copy()
+        data.update(changes)
+        return nkInvoice(opus_data=opus_config(), invoice_data=data, master_data=index)
+    ########################################################################################################################
+    ### Tests
+    ########################################################################################################################
+    # *************************************************************************************************************
+    def test_lookup(self):
+        index = MasterDataIndex()
+        self.assertEqual(index.refresh(self.export_file), 4)
+        self.assertTrue(index.lookup_artskonto(40000000))
+        self.assertFalse(index.lookup_artskonto(40000001))
+        self.assertIsNone(index.lookup_artskonto(49999999))
+        self.assertTrue(index.lookup_psp(" xg-0000000204-00001 "))
+        self.assertIsNone(index.lookup_psp("XG-0000000000-00000"))
+    # *************************************************************************************************************
+    def test_incremental_refresh(self):
+        index = MasterDataIndex(self.db_path)
+        self.assertEqual(index.refresh(self.export_file), 4)
+        # Unchanged file is skipped
+        self.assertEqual(index.refresh(self.export_file), 0)
+        # Only changed and removed entries are written
+        self._write_export([
+            ("Artskonto", "40000000", "Lukket"),
+            ("Artskonto", "40000001", "Lukket"),
+            ("PSP", "XG-0000000204-00001", "Åben"),
+        ], mtime_ns=os.stat(self.export_file).st_mtime_ns + 1)
+        self.assertEqual(index.refresh(self.export_file), 2)
+        self.assertFalse(index.lookup_artskonto(40000000))
+        self.assertIsNone(index.lookup_psp("XG-0000002473-00029"))
+        index.close()
+        # Index is kept on disk
+        index = MasterDataIndex(self.db_path)
+        self.assertEqual(len(index), 3)
+        self.assertFalse(index.lookup_artskonto(40000000))
+        self.assertEqual(index.refresh(self.export_file), 0)
+        index.close()
+    # *************************************************************************************************************
+    def test_several_exports(self):
+        arts = Path(self.tmp.name) / "arts.csv"
+        psp = Path(self.tmp.name) / "psp.csv"
+        arts.write_text("Type;Nummer;Status\nArtskonto;40000000;Åben\nArtskonto;40000001;Åben\n", encoding="utf-8")
+        psp.write_text("Type;Nummer;Status\nPSP;XG-0000000204-00001;Åben\nArtskonto;40000001;Lukket\n", encoding="utf-8")
+        index = MasterDataIndex(self.db_path)
+        self.assertEqual(index.refresh(arts), 2)
+        self.assertEqual(index.refresh(psp), 2)
+        # Loading the second export keeps the first one
+        self.assertTrue(index.lookup_artskonto(40000000))
+        self.assertTrue(index.lookup_psp("XG-0000000204-00001"))
+        # Closed in one export -> closed
+        self.assertFalse(index.lookup_artskonto(40000001))
+        self.assertEqual(index.refresh(arts), 0)
+        self.assertTrue(index.lookup_artskonto(40000000))
+        # Changing one export only touches its own entries, also after reopening
+        psp.write_text("Type;Nummer;Status\nPSP;XG-0000000204-00001;Åben\n", encoding="utf-8")
+        os.utime(psp, ns=(os.stat(psp).st_mtime_ns + 1, os.stat(psp).st_mtime_ns + 1))
+        self.assertEqual(index.refresh(psp), 1)
+        self.assertTrue(index.lookup_artskonto(40000001))
+        index.close()
+        index = MasterDataIndex(self.db_path)
+        self.assertEqual(len(index), 3)
+        self.assertTrue(index.lookup_artskonto(40000000))
+        self.assertEqual(index.refresh(arts), 0)
+        index.close()
+    # *************************************************************************************************************
+    def test_only_artskonto_loaded(self):
+        self._write_export([("Artskonto", "40000000", "Åben"), ("Artskonto", "40000001", "Lukket")])
+        index = MasterDataIndex()
+        index.refresh(self.export_file)
+        self.assertTrue(index.has_type("Artskonto"))
+        self.assertFalse(index.has_type("PSP"))
+        # PSP elements are not checked without a PSP export, Artskonto still is
+        self.assertEqual(self._invoice(index)._check_master_data(), [])
+        self.assertEqual(self._invoice(index, Debet_Artskonto=49999999)._check_master_data(), ["Debet_Artskonto 49999999 findes ikke i stamdata"])
+        self.assertEqual(self._invoice(index, Kredit_Artskonto=40000001)._check_master_data(), ["Kredit_Artskonto 40000001 er lukket"])
+    # *************************************************************************************************************
+    def test_unknown_type(self):
+        self._write_export([("Konto", "40000000", "Åben")])
+        with self.assertRaises(ValueError):
+            MasterDataIndex().refresh(self.export_file)
+    # *************************************************************************************************************
+    def test_invoice_rejected_before_opus(self):
+        index = MasterDataIndex()
+        index.refresh(self.export_file)
+        # Valid postings pass
+        self.assertEqual(self._invoice(index)._check_master_data(), [])
+        self.assertEqual(self._invoice(None)._check_master_data(), [])
+        self.assertEqual(self._invoice(index, Debet_PSP="", Kredit_PSP="")._check_master_data(), [])
+        # Closed and unknown postings are rejected without logging in
+        invoice = self._invoice(index, Kredit_Artskonto=40000001, Debet_PSP="XG-0000000000-00000")
+        result = invoice.create_invoice()
+        self.assertEqual(result["status"], "Fejlet")
+        self.assertIn("Kredit_Artskonto 40000001 er lukket", result["bilag"])
+        self.assertIn("Debet_PSP XG-0000000000-00000 findes ikke i stamdata", result["bilag"])
+        self.assertFalse(self.invoice_data["csv_filename"].exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import tempfile
+from pathlib import Path
+from unittest import mock
+from Invoice.src._master_data import MasterDataIndex
+from Invoice.src._rate_limit import reset_rate_limiters
+from Invoice.src.nkInvoice import nkInvoice, InvoiceData, OPUS_CSV_HEADERS
+from fakes import fake_playwright, opus_config
+
+class FakePage:
+    """ Stands in for a Playwright page, the tests only follow which page each voucher is filled on. """
+    def __init__(self, name, events):
+        self.name = name
+        self.events = events
+        self.closed = False
+    def goto(self, url):
+        self.events.append(f"goto {self.name}")
+    def close(self):
+        self.closed = True
+
+class FakeContext:
+    def __init__(self, events):
+        self.events = events
+        self.pages = []
+        self.closed = False
+    def new_page(self):
+        page = FakePage(f"page{len(self.pages) + 1}", self.events)
+        self.pages.append(page)
+        return page
+    def close(self):
+        self.closed = True
+
+class FakeSession:
+    """ Patches the Playwright steps of nkInvoice, so create_invoices runs without a browser.
+    fail_forms is the number of times opening the voucher form in a new tab fails. """
+    def __init__(self, fail_forms=0):
+        self.events = []
+        self.context = FakeContext(self.events)
+        self.fail_forms = fail_forms
+
+    def patches(self):
+        session = self
+        def start(invoice, playwright):
+            invoice._context = session.context
+            invoice._page = session.context.new_page()
+            invoice._portal_url = "https://opus.test/portal"
+        def open_form(invoice, page):
+            if session.fail_forms > 0:
+                session.fail_forms -= 1
+                raise RuntimeError("Opret omposteringsbilag not found")
+            session.events.append(f"form {page.name}")
+        def fill(invoice):
+            session.events.append(f"fill {invoice.invoice_data.Tekst} on {invoice._page.name}")
+        def start_check(invoice):
+            session.events.append(f"check {invoice.invoice_data.Tekst}")
+        def read_check(invoice):
+            session.events.append(f"read {invoice.invoice_data.Tekst}")
+            return "Omposteringsbilaget er kontrolleret og OK"
+        return [
+            mock.patch("Invoice.src.nkInvoice.sync_playwright", fake_playwright),
+            mock.patch.object(nkInvoice, "_start_opus_rollebaseret", start),
+            mock.patch.object(nkInvoice, "_open_voucher_form", open_form),
+            mock.patch.object(nkInvoice, "_fill_voucher", fill),
+            mock.patch.object(nkInvoice, "_start_check", start_check),
+            mock.patch.object(nkInvoice, "_read_check", read_check),
+        ]
+
+    def run(self, invoice, invoices):
+        patches = self.patches()
+        for patch in patches:
+            patch.start()
+        try:
+            return invoice.create_invoices(invoices)
+        finally:
+            for patch in patches:
+                patch.stop()
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        reset_rate_limiters()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bilag = Path(self.tmp.name) / "bilag.pdf"
+        self.bilag.write_bytes(b"%PDF-1.4 test")
+        self.opus = opus_config()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _invoice_data(self, n, **changes):
+        data = {"Tekst": f"Test {n}", "Debet_Artskonto": 40000000, "Kredit_Artskonto": 40000000, "Kost": 1.0, "csv_filename": Path(self.tmp.name) / f"opus_{n}.csv"}
+        data.update(changes)
+        return InvoiceData(**data)
+    ########################################################################################################################
+    ### Tests
+    ########################################################################################################################
+    # *************************************************************************************************************
+    def test_prepare_voucher(self):
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=self._invoice_data(1, BilagsFilePath=str(self.bilag)))
+        attachment = invoice._prepare_voucher()
+        self.assertEqual(attachment, {"name": "bilag.pdf", "mimeType": "application/pdf", "buffer": b"%PDF-1.4 test"})
+        lines = invoice.invoice_data.csv_filename.read_text(encoding="utf-8").splitlines()
+        self.assertEqual(lines[0].split(";"), OPUS_CSV_HEADERS)
+        self.assertEqual(len(lines), 3)
+        # No attachment
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=self._invoice_data(2))
+        self.assertIsNone(invoice._prepare_voucher())
+    # *************************************************************************************************************
+    def test_create_invoices_rejected_without_session(self):
+        export_file = Path(self.tmp.name) / "stamdata.csv"
+        export_file.write_text("Type;Nummer;Status\nArtskonto;40000000;Åben\nArtskonto;40000001;Lukket\n", encoding="utf-8")
+        master_data = MasterDataIndex()
+        master_data.refresh(export_file)
+        invoices = [self._invoice_data(1, Kredit_Artskonto=40000001), self._invoice_data(2, Debet_Artskonto=40000001)]
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=invoices[0], master_data=master_data)
+        results = invoice.create_invoices(invoices)
+        self.assertEqual([result["status"] for result in results], ["Fejlet", "Fejlet"])
+        self.assertIn("Kredit_Artskonto 40000001 er lukket", results[0]["bilag"])
+        self.assertIn("Debet_Artskonto 40000001 er lukket", results[1]["bilag"])
+        self.assertFalse(invoices[0].csv_filename.exists())
+    # *************************************************************************************************************
+    def test_create_invoices_pipeline(self):
+        invoices = [self._invoice_data(n) for n in (1, 2, 3)]
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=invoices[0])
+        session = FakeSession()
+        results = session.run(invoice, invoices)
+        self.assertEqual([result["status"] for result in results], ["Succes", "Succes", "Succes"])
+        # The next voucher is opened in a new tab while SAP checks the current one
+        self.assertEqual(session.events, [
+            "fill Test 1 on page1", "check Test 1", "goto page2", "form page2", "read Test 1",
+            "fill Test 2 on page2", "check Test 2", "goto page3", "form page3", "read Test 2",
+            "fill Test 3 on page3", "check Test 3", "read Test 3",
+        ])
+        self.assertTrue(all(page.closed for page in session.context.pages))
+        self.assertTrue(session.context.closed)
+        # The CSV of every voucher was written
+        self.assertTrue(all(data.csv_filename.exists() for data in invoices))
+        self.assertEqual(invoice.invoice_data, invoices[0])
+    # *************************************************************************************************************
+    def test_create_invoices_prepare_retried(self):
+        invoices = [self._invoice_data(n) for n in (1, 2)]
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=invoices[0])
+        # Opening the form fails while SAP checks voucher 1, the retry after the check works
+        session = FakeSession(fail_forms=1)
+        results = session.run(invoice, invoices)
+        self.assertEqual([result["status"] for result in results], ["Succes", "Succes"])
+        self.assertIn("read Test 1", session.events)
+        self.assertIn("fill Test 2 on page3", session.events)
+        self.assertTrue(session.context.closed)
+    # *************************************************************************************************************
+    def test_create_invoices_prepare_failed(self):
+        invoices = [self._invoice_data(n) for n in (1, 2, 3)]
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=invoices[0])
+        # Opening the form for voucher 2 fails both times, voucher 1 is still read and voucher 3 still created
+        session = FakeSession(fail_forms=2)
+        results = session.run(invoice, invoices)
+        self.assertEqual([result["status"] for result in results], ["Succes", "Fejlet", "Succes"])
+        self.assertIn("Opret omposteringsbilag not found", results[1]["error"])
+        self.assertNotIn("error", results[0])
+        self.assertIn("read Test 1", session.events)
+        self.assertNotIn("check Test 2", session.events)
+        self.assertIn("read Test 3", session.events)
+        self.assertTrue(all(page.closed for page in session.context.pages))
+        self.assertTrue(session.context.closed)
+    # *************************************************************************************************************
+    def test_create_invoices_first_prepare_failed(self):
+        # The CSV of the first voucher cannot be written, the login tab is closed and the next voucher gets a new tab
+        invoices = [self._invoice_data(1, csv_filename=Path(self.tmp.name) / "missing" / "opus_1.csv"), self._invoice_data(2)]
+        invoice = nkInvoice(opus_data=self.opus, invoice_data=invoices[0])
+        session = FakeSession()
+        results = session.run(invoice, invoices)
+        self.assertEqual([result["status"] for result in results], ["Fejlet", "Succes"])
+        self.assertIn("_create_opus_csv", results[0]["error"])
+        self.assertTrue(session.context.pages[0].closed)
+        self.assertIn("fill Test 2 on page2", session.events)
+        self.assertTrue(session.context.closed)
+
+if __name__ == '__main__':
+    unittest.main()
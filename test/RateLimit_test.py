@@ -0,0 +1,123 @@
+import logging
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+from Invoice.src._rate_limit import OpusRateLimit, OpusRateLimiter, TokenBucket, get_rate_limiter, reset_rate_limiters
+from Invoice.src.nkInvoice import nkInvoice, CHECK_TIMEOUT
+from fakes import FakeClock, opus_config
+
+class FakeCheckPage:
+    """ Page and frames of the voucher form, waiting moves the fake clock. """
+    def __init__(self, clock):
+        self.clock = clock
+    def frame_locator(self, selector):
+        return self
+    def wait_for_timeout(self, ms):
+        self.clock.now += ms / 1000
+
+class FakeControlMessages:
+    """ The control messages, SAP answers at answer_at on the fake clock. """
+    def __init__(self, clock, before, answer, answer_at):
+        self.clock = clock
+        self.before = before
+        self.answer = answer
+        self.answer_at = answer_at
+    def all_text_contents(self):
+        return self.answer if self.clock.now >= self.answer_at else self.before
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        reset_rate_limiters()
+        self.clock = FakeClock()
+    ########################################################################################################################
+    ### Tests
+    ########################################################################################################################
+    # *************************************************************************************************************
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2.0, clock=self.clock, sleep=self.clock.sleep)
+        # First token is free, the next ones are spaced by 1/rate
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        # Tokens refill while idle, but never above capacity
+        self.clock.now += 10
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+    # *************************************************************************************************************
+    def test_login_limit(self):
+        limiter = OpusRateLimiter(OpusRateLimit(logins_per_minute=6), clock=self.clock, sleep=self.clock.sleep)
+        self.assertEqual(limiter.acquire_login(), 0.0)
+        self.assertAlmostEqual(limiter.acquire_login(), 10.0)
+    # *************************************************************************************************************
+    def test_adaptive_slowdown(self):
+        limiter = OpusRateLimiter(OpusRateLimit(checks_per_second=1, min_rate_fraction=0.25), clock=self.clock, sleep=self.clock.sleep)
+        limiter.record_latency("check", 1.0)
+        self.assertEqual(limiter.rate_fraction, 1.0)
+        # Much slower answers halve the rate down to the minimum
+        limiter.record_latency("check", 5.0)
+        self.assertEqual(limiter.rate_fraction, 0.5)
+        limiter.record_latency("check", 20.0)
+        limiter.record_latency("check", 80.0)
+        self.assertEqual(limiter.rate_fraction, 0.25)
+        limiter.acquire_check()
+        self.assertAlmostEqual(limiter.acquire_check(), 4.0)
+        # Normal answers speed up again
+        for _ in range(20):
+            limiter.record_latency("check", 1.0)
+        self.assertEqual(limiter.rate_fraction, 1.0)
+    # *************************************************************************************************************
+    def test_adaptive_disabled(self):
+        limiter = OpusRateLimiter(OpusRateLimit(adaptive=False), clock=self.clock, sleep=self.clock.sleep)
+        limiter.record_latency("check", 1.0)
+        limiter.record_latency("check", 50.0)
+        self.assertEqual(limiter.rate_fraction, 1.0)
+    # *************************************************************************************************************
+    def test_sessions(self):
+        limiter = OpusRateLimiter(OpusRateLimit(max_sessions=1))
+        with limiter.session():
+            self.assertFalse(limiter._sessions.acquire(blocking=False))
+        self.assertTrue(limiter._sessions.acquire(blocking=False))
+    # *************************************************************************************************************
+    def test_shared_per_user_and_url(self):
+        opus = opus_config(url="https://opus.test/")
+        same = opus_config(username="BRUGER")
+        other = opus_config(username="anden")
+        self.assertIs(opus.rate_limiter(), same.rate_limiter())
+        self.assertIsNot(opus.rate_limiter(), other.rate_limiter())
+        self.assertIs(get_rate_limiter("https://opus.test", "bruger", OpusRateLimit()), opus.rate_limiter())
+    # *************************************************************************************************************
+    def test_different_limits_warns(self):
+        first = get_rate_limiter("https://opus.test", "bruger", OpusRateLimit(logins_per_minute=6))
+        with self.assertLogs("Invoice.src._rate_limit", level="WARNING") as logs:
+            second = get_rate_limiter("https://opus.test", "bruger", OpusRateLimit(logins_per_minute=60))
+        self.assertIs(first, second)
+        self.assertEqual(second.limits.logins_per_minute, 6)
+        self.assertIn("ignoring", logs.output[0])
+    # *************************************************************************************************************
+    def test_check_latency(self):
+        invoice = nkInvoice(opus_data=opus_config(), invoice_data={"Tekst": "Test", "Debet_Artskonto": 40000000, "Kredit_Artskonto": 40000000, "Kost": 1.0, "csv_filename": Path("opus.csv")})
+        invoice._rate_limiter = OpusRateLimiter(OpusRateLimit(), clock=self.clock, sleep=self.clock.sleep)
+        invoice._page = FakeCheckPage(self.clock)
+        invoice._logger = logging.getLogger("nkInvoice.test")
+        ok = ["Omposteringsbilaget er kontrolleret og OK"]
+        messages = FakeControlMessages(self.clock, before=[], answer=ok, answer_at=1.5)
+        with mock.patch("Invoice.src.nkInvoice.time", SimpleNamespace(perf_counter=self.clock)), mock.patch.object(nkInvoice, "_control_message_locator", lambda invoice, frame: messages):
+            # SAP answers 1.5 s after the click
+            invoice._check_messages_before = []
+            self.assertEqual(invoice._read_check(), ok[0])
+            self.assertAlmostEqual(invoice._rate_limiter._latency["check"], 1.5)
+            # The messages do not change: logged, and the timeout is not taken as an answer time
+            self.clock.now = 100.0
+            invoice._check_started = self.clock.now
+            invoice._check_messages_before = ok
+            messages.before, messages.answer_at = ok, float("inf")
+            with self.assertLogs("nkInvoice.test", level="WARNING") as logs:
+                self.assertEqual(invoice._read_check(), ok[0])
+            self.assertIn("did not change", logs.output[0])
+            self.assertGreaterEqual(self.clock.now - 100.0, CHECK_TIMEOUT / 1000)
+            self.assertAlmostEqual(invoice._rate_limiter._latency["check"], 1.5)
+            self.assertEqual(invoice._rate_limiter.rate_fraction, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import json
+import unittest
+import tempfile
+from pathlib import Path
+from unittest import mock
+from playwright.sync_api import sync_playwright
+from Invoice.src._har import HarConfig, scrub_har, SCRUBBED_USERNAME, SCRUBBED_PASSWORD
+from Invoice.src._rate_limit import OpusRateLimit, reset_rate_limiters
+from Invoice.src.nkInvoice import nkInvoice, OpusConfig, LaunchProfile
+from dotenv import load_dotenv
+from fakes import fake_playwright, opus_config
+
+## Offline performance regression test
+## Record a session once against OPUS (see README), then point OPUS_REPLAY_HAR at the HAR file and
+## OPUS_REPLAY_INVOICE at a JSON file with the invoice data used for the recording.
+## The first replay writes <har>.timings.json as baseline, later replays fail when a step gets slower than the baseline.
+## test_replay_fixture runs the same replay offline against the checked-in fixtures/opus_replay.har.
+REPLAY_TOLERANCE = float(os.getenv("OPUS_REPLAY_TOLERANCE", "0.25"))  # allowed slowdown, 0.25 = 25%
+REPLAY_SLACK = 0.5                                                     # seconds, absorbs jitter on short steps
+FIXTURE_HAR = Path(__file__).parent / "fixtures" / "opus_replay.har"
+
+class FakeRecordingContext:
+    """ Stands in for a recording BrowserContext, writes the HAR file on close like Playwright does. """
+    def __init__(self, path, password):
+        self.path = path
+        self.password = password
+    def close(self):
+        har = {"log": {"entries": [{"request": {"url": "https://opus.test/login", "headers": [], "cookies": [], "postData": {"text": f"Password={self.password}"}}, "response": {"headers": [], "cookies": []}}]}}
+        Path(self.path).write_text(json.dumps(har), encoding="utf-8")
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        reset_rate_limiters()
+        load_dotenv()
+        self.har_path = os.getenv("OPUS_REPLAY_HAR")
+        self.invoice_path = os.getenv("OPUS_REPLAY_INVOICE")
+
+    def _assert_within_baseline(self, timings: dict, baseline: dict):
+        for step, seconds in baseline.items():
+            budget = seconds * (1 + REPLAY_TOLERANCE) + REPLAY_SLACK
+            self.assertLessEqual(timings[step], budget, f"Step '{step}' took {timings[step]:.2f} s, baseline is {seconds:.2f} s")
+
+    def _replay_fixture(self, invoice_data: dict) -> dict:
+        # Login, portal, voucher form and "Kontroller bilag" served from the fixture, returns the timings per step
+        limits = OpusRateLimit(logins_per_minute=600, checks_per_second=100)
+        opus = opus_config(url="https://opus-replay.test", username=SCRUBBED_USERNAME, password=SCRUBBED_PASSWORD, rate_limit=limits)
+        invoice = nkInvoice(opus_data=opus, invoice_data=invoice_data, launch_profile=LaunchProfile(headless=True), har=HarConfig(path=FIXTURE_HAR, mode="replay"))
+        invoice._rate_limiter = opus.rate_limiter()
+        with sync_playwright() as playwright:
+            try:
+                with invoice._timed("start_opus"):
+                    invoice._start_opus_rollebaseret(playwright)
+                self.assertEqual(invoice._check_invoice(), "Omposteringsbilaget er kontrolleret og OK")
+                # Requests that are not in the HAR file are aborted, OPUS is never contacted
+                with self.assertRaises(Exception):
+                    invoice._page.goto("https://opus-replay.test/not-recorded")
+            except RuntimeError as e:
+                if "Executable doesn't exist" in str(e):
+                    self.skipTest("Chromium is not installed, run 'playwright install chromium'")
+                raise
+            finally:
+                invoice._close_browser()
+        return invoice._timings
+    ########################################################################################################################
+    ### Tests
+    ########################################################################################################################
+    # *************************************************************************************************************
+    def test_scrub_har(self):
+        har = {"log": {"entries": [{
+            "request": {
+                "url": "https://opus.test/adfs/ls?username=domain%5Cuserjx",
+                "headers": [{"name": "Cookie", "value": "MYSAPSSO2=secret"}, {"name": "Accept", "value": "*/*"}],
+                "cookies": [{"name": "MYSAPSSO2", "value": "secret"}],
+                "postData": {"text": "UserName=domain%5Cuserjx&Password=Passw0rd%21", "params": [{"name": "Password", "value": "Passw0rd!"}]}
+            },
+            "response": {"headers": [{"name": "Set-Cookie", "value": "MYSAPSSO2=secret"}], "cookies": [], "content": {"text": "Welcome domain\\userjx"}}
+        }]}}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "session.har"
+            path.write_text(json.dumps(har), encoding="utf-8")
+            scrub_har(path, username="domain\\userjx", password="Passw0rd!")
+            text = path.read_text(encoding="utf-8")
+        for secret in ("userjx", "Passw0rd", "secret"):
+            self.assertNotIn(secret, text)
+        entry = json.loads(text)["log"]["entries"][0]
+        self.assertEqual(entry["request"]["postData"]["text"], f"UserName={SCRUBBED_USERNAME}&Password={SCRUBBED_PASSWORD}")
+        self.assertEqual(entry["request"]["headers"][1]["value"], "*/*")
+    # *************************************************************************************************************
+    def test_scrub_har_keeps_urls(self):
+        # A short username must not change recorded urls, replay needs them to match exactly
+        har = {"log": {"entries": [{
+            "request": {"url": "https://opus.test/sap/opu/odata?user=op&mode=opus", "headers": [], "cookies": [], "queryString": [{"name": "user", "value": "op"}, {"name": "mode", "value": "opus"}]},
+            "response": {"headers": [{"name": "Location", "value": "https://opus.test/opus?user=op"}], "cookies": [], "content": {"text": "user op logged in"}}
+        }]}}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "session.har"
+            path.write_text(json.dumps(har), encoding="utf-8")
+            scrub_har(path, username="op", password="Passw0rd!")
+            entry = json.loads(path.read_text(encoding="utf-8"))["log"]["entries"][0]
+        self.assertEqual(entry["request"]["url"], f"https://opus.test/sap/opu/odata?user={SCRUBBED_USERNAME}&mode=opus")
+        self.assertEqual(entry["request"]["queryString"][1]["value"], "opus")
+        self.assertEqual(entry["response"]["headers"][0]["value"], f"https://opus.test/opus?user={SCRUBBED_USERNAME}")
+        self.assertEqual(entry["response"]["content"]["text"], f"user {SCRUBBED_USERNAME} logged in")
+    # *************************************************************************************************************
+    def test_failed_recording_is_scrubbed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            har_path = Path(tmp) / "session.har"
+            opus = opus_config(password="Passw0rd!")
+            invoice_data = {"Tekst": "Test", "Debet_Artskonto": 40000000, "Kredit_Artskonto": 40000000, "Kost": 1.0, "csv_filename": Path(tmp) / "opus.csv"}
+            invoice = nkInvoice(opus_data=opus, invoice_data=invoice_data, har=HarConfig(path=har_path, mode="record"))
+
+            def failing_login(self, playwright):
+                self._context = FakeRecordingContext(har_path, opus.password)
+                raise RuntimeError("Login failed: wrong password")
+
+            with mock.patch("Invoice.src.nkInvoice.sync_playwright", fake_playwright), mock.patch.object(nkInvoice, "_start_opus_rollebaseret", failing_login):
+                with self.assertRaises(RuntimeError):
+                    invoice.create_invoice()
+            text = har_path.read_text(encoding="utf-8")
+        self.assertNotIn("Passw0rd", text)
+        self.assertIn(SCRUBBED_PASSWORD, text)
+    # *************************************************************************************************************
+    def test_replay_timings(self):
+        if not self.har_path or not self.invoice_path:
+            self.skipTest("OPUS_REPLAY_HAR and OPUS_REPLAY_INVOICE not set")
+        invoice_data = json.loads(Path(self.invoice_path).read_text(encoding="utf-8"))
+        opus = OpusConfig(url=os.getenv("OPUS_URL"), municipality_code=int(os.getenv("OPUS_MUNICIPALITY_CODE")), username=SCRUBBED_USERNAME, password=SCRUBBED_PASSWORD)
+        invoice = nkInvoice(opus_data=opus, invoice_data=invoice_data, launch_profile=LaunchProfile(headless=True), har=HarConfig(path=self.har_path, mode="replay"))
+        result = invoice.create_invoice()
+        self.assertEqual(result["status"], "Succes")
+
+        baseline_path = Path(self.har_path).with_suffix(".timings.json")
+        if not baseline_path.exists():
+            baseline_path.write_text(json.dumps(invoice._timings, indent=2), encoding="utf-8")
+            self.skipTest(f"Baseline timings written to {baseline_path}")
+        self._assert_within_baseline(invoice._timings, json.loads(baseline_path.read_text(encoding="utf-8")))
+    # *************************************************************************************************************
+    def test_replay_fixture(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            invoice_data = {"Tekst": "Test", "Debet_Artskonto": 40000000, "Kredit_Artskonto": 40000000, "Kost": 1.0, "csv_filename": Path(tmp) / "opus.csv"}
+            # The first replay is the baseline for the second
+            baseline = self._replay_fixture(invoice_data)
+            self.assertEqual(set(baseline), {"start_opus", "login", "check_invoice"})
+            self._assert_within_baseline(self._replay_fixture(invoice_data), baseline)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import csv
+import json
+import sqlite3
+import unittest
+import tempfile
+from pathlib import Path
+from Invoice.src._results import BatchSummary, ResultSink, JsonlResultSink, open_result_sink, make_record, input_hash
+from Invoice.src._master_data import MasterDataIndex
+from Invoice.src._rate_limit import reset_rate_limiters
+from Invoice.src.nkInvoice import nkInvoice, InvoiceData, run_batch
+from fakes import FakeClock, opus_config
+
+class TestResults(unittest.TestCase):
+    def setUp(self):
+        reset_rate_limiters()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.invoice_data = InvoiceData(Tekst="Test af tekst", Reference="ref-1", Debet_Artskonto=40000000, Kredit_Artskonto=40000001, Kost=1.0, csv_filename=Path(self.tmp.name) / "opus.csv")
+        self.ok = make_record(self.invoice_data, {"status": "Succes", "message": "Bilag oprettet", "bilag": "Omposteringsbilaget er kontrolleret og OK", "messages": ["Omposteringsbilaget er kontrolleret og OK"]}, {"total": 12.5})
+        self.failed = make_record(self.invoice_data, {"status": "Fejlet", "message": "Bilag ikke oprettet", "bilag": "Artskonto 40000001 er spærret", "messages": ["Artskonto 40000001 er spærret", "Bilaget indeholder fejl"]}, {"total": 10.0})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+    ########################################################################################################################
+    ### Tests
+    ########################################################################################################################
+    # *************************************************************************************************************
+    def test_record(self):
+        self.assertEqual(self.ok["input_hash"], input_hash(self.invoice_data))
+        self.assertEqual(self.ok["reference"], "ref-1")
+        # Local paths do not change the hash, posting data does
+        moved = self.invoice_data.model_copy(update={"csv_filename": Path("/other/opus.csv"), "BilagsFilePath": "/other/bilag.pdf"})
+        self.assertEqual(input_hash(moved), self.ok["input_hash"])
+        self.assertNotEqual(input_hash(self.invoice_data.model_copy(update={"Kost": 2.0})), self.ok["input_hash"])
+        self.assertEqual(self.failed["messages"], ["Artskonto 40000001 er spærret", "Bilaget indeholder fejl"])
+        # Exceptions give a failed record
+        record = make_record(self.invoice_data, None, {}, RuntimeError("Login failed: wrong password"))
+        self.assertEqual(record["status"], "Fejlet")
+        self.assertEqual(record["error"], "Login failed: wrong password")
+    # *************************************************************************************************************
+    def test_buffered_writes(self):
+        path = Path(self.tmp.name) / "results.jsonl"
+        sink = JsonlResultSink(path, buffer_size=2)
+        sink.write(self.ok)
+        self.assertFalse(path.exists())
+        sink.write(self.failed)
+        self.assertEqual(len(path.read_text(encoding="utf-8").splitlines()), 2)
+        sink.write(self.ok)
+        sink.close()
+        lines = path.read_text(encoding="utf-8").splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[1])["messages"][1], "Bilaget indeholder fejl")
+    # *************************************************************************************************************
+    def test_sink_is_abstract(self):
+        with self.assertRaises(TypeError):
+            ResultSink(Path(self.tmp.name) / "results.jsonl")
+    # *************************************************************************************************************
+    def test_sink_types(self):
+        for name in ("results.jsonl", "results.csv", "results.sqlite"):
+            path = Path(self.tmp.name) / name
+            with open_result_sink(path) as sink:
+                sink.write(self.ok)
+                sink.write(self.failed)
+            if path.suffix == ".csv":
+                with open(path, newline="", encoding="utf-8") as f:
+                    rows = list(csv.DictReader(f, delimiter=";"))
+                self.assertEqual(rows[1]["status"], "Fejlet")
+                self.assertEqual(json.loads(rows[1]["timings"]), {"total": 10.0})
+            elif path.suffix == ".sqlite":
+                db = sqlite3.connect(path)
+                rows = db.execute("SELECT status, messages FROM results").fetchall()
+                db.close()
+                self.assertEqual(rows[0][0], "Succes")
+                self.assertEqual(len(json.loads(rows[1][1])), 2)
+            else:
+                self.assertEqual(len(path.read_text(encoding="utf-8").splitlines()), 2)
+        with self.assertRaises(ValueError):
+            open_result_sink(Path(self.tmp.name) / "results.txt")
+    # *************************************************************************************************************
+    def test_summary(self):
+        clock = FakeClock()
+        summary = BatchSummary(clock=clock)
+        summary.add(self.ok)
+        summary.add(self.failed)
+        summary.add(make_record(self.invoice_data, {"status": "Fejlet", "message": "Bilag ikke oprettet", "bilag": "Artskonto 40000002 er spærret"}, {}))
+        summary.add(make_record(self.invoice_data, None, {}, RuntimeError("Login failed: wrong password")))
+        clock.now = 120.0
+        summary.finish()
+        self.assertEqual(summary.success_rate, 0.25)
+        self.assertEqual(summary.throughput, 2.0)
+        self.assertEqual(summary.failures, {"Artskonto # er spærret": 2, "Login fejlet": 1})
+        self.assertEqual(summary.as_dict()["failed"], 3)
+    # *************************************************************************************************************
+    def test_run_batch(self):
+        export_file = Path(self.tmp.name) / "stamdata.csv"
+        export_file.write_text("Type;Nummer;Status\nArtskonto;40000000;Åben\nArtskonto;40000001;Lukket\n", encoding="utf-8")
+        master_data = MasterDataIndex()
+        master_data.refresh(export_file)
+        opus = opus_config()
+        invoices = []
+        for _ in range(3):
+            invoices.append(nkInvoice(opus_data=opus, invoice_data=self.invoice_data, master_data=master_data))
+        path = Path(self.tmp.name) / "results.jsonl"
+        summary = run_batch(invoices, open_result_sink(path))
+        self.assertEqual(summary.total, 3)
+        self.assertEqual(summary.failures, {"Kredit_Artskonto # er lukket": 3})
+        self.assertEqual(len(path.read_text(encoding="utf-8").splitlines()), 3)
+        self.assertEqual(json.loads(path.with_suffix(".summary.json").read_text(encoding="utf-8"))["total"], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+from Invoice.src.nkInvoice import OpusConfig
+
+## Fakes shared by the offline tests
+
+class FakeClock:
+    """ Clock for the rate limiter and batch summary, sleeping moves the clock instead of waiting. """
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += seconds
+
+@contextmanager
+def fake_playwright():
+    # Stands in for sync_playwright(), when the browser steps are patched
+    yield None
+
+def opus_config(**changes) -> OpusConfig:
+    """OPUS test config, the rate limiters are shared per user and url, so call reset_rate_limiters() in setUp."""
+    data = {"url": "https://opus.test", "municipality_code": 123, "username": "bruger", "password": "kode1234"}
+    data.update(changes)
+    return OpusConfig(**data)